@@ -0,0 +1,173 @@
+import logging
+import re
+import time
+from collections import OrderedDict
+from urllib.parse import urljoin, urlparse
+
+from gevent.pool import Pool
+
+log = logging.getLogger(__name__)
+
+_ASSET_PATTERNS = [
+    re.compile(r'<link\b[^>]*\brel="(?:stylesheet|icon|shortcut icon|preload)"[^>]*\bhref="([^"]+)"', re.IGNORECASE),
+    re.compile(r'<link\b[^>]*\bhref="([^"]+)"[^>]*\brel="(?:stylesheet|icon|shortcut icon|preload)"', re.IGNORECASE),
+    re.compile(r'<script\b[^>]*\bsrc="([^"]+)"', re.IGNORECASE),
+    re.compile(r'<img\b[^>]*\bsrc="([^"]+)"', re.IGNORECASE),
+]
+
+_CSS_URL_PATTERN = re.compile(r'url\(\s*[\'"]?([^\'")]+?)[\'"]?\s*\)')
+
+_MAX_AGE_PATTERN = re.compile(r'max-age=(\d+)')
+
+# Asset references only depend on the template used to render a page, so they are parsed once per template
+# (keyed on the block id at the end of the url) and once per stylesheet, and shared between all sessions. Template
+# references are kept as written in the page and resolved against each response, as sessions may use different hosts.
+_template_assets = {}
+_stylesheet_assets = {}
+
+
+def get_template_key(url):
+    return urlparse(url).path.rstrip('/').rsplit('/', 1)[-1]
+
+
+def extract_assets(html):
+    assets = []
+    for pattern in _ASSET_PATTERNS:
+        for match in pattern.finditer(html):
+            reference = match.group(1)
+            if reference not in assets and not reference.startswith('data:'):
+                assets.append(reference)
+    return assets
+
+
+def extract_stylesheet_assets(css, base_url):
+    assets = []
+    for match in _CSS_URL_PATTERN.finditer(css):
+        if match.group(1).startswith('data:'):
+            continue
+        asset_url = urljoin(base_url, match.group(1))
+        if asset_url not in assets:
+            assets.append(asset_url)
+    return assets
+
+
+class AssetCache:
+    """
+    Bounded LRU cache of asset responses which follows the parts of browser caching that affect
+    what gets sent to the server: fresh entries are not requested at all, stale entries are
+    revalidated with If-None-Match / If-Modified-Since and no-store responses are never kept.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, url):
+        entry = self._entries.get(url)
+        if entry is not None:
+            self._entries.move_to_end(url)
+        return entry
+
+    def is_fresh(self, url):
+        entry = self.get(url)
+        return entry is not None and entry['expires'] > time.time()
+
+    def conditional_headers(self, url):
+        entry = self.get(url)
+        headers = {}
+        if entry is None:
+            return headers
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, response):
+        cache_control = response.headers.get('Cache-Control', '').lower()
+        if 'no-store' in cache_control:
+            self._entries.pop(url, None)
+            return
+
+        entry = self._entries.get(url, {'max_age': 0, 'etag': None, 'last_modified': None})
+
+        max_age = _MAX_AGE_PATTERN.search(cache_control)
+        if response.status_code == 304 and not cache_control:
+            # A revalidation without its own Cache-Control keeps the stored response's freshness lifetime
+            max_age_seconds = entry['max_age']
+        elif 'no-cache' in cache_control or not max_age:
+            max_age_seconds = 0
+        else:
+            max_age_seconds = int(max_age.group(1))
+
+        self._entries[url] = {
+            'max_age': max_age_seconds,
+            'expires': time.time() + max_age_seconds if max_age_seconds else 0,
+            'etag': response.headers.get('ETag', entry['etag']),
+            'last_modified': response.headers.get('Last-Modified', entry['last_modified']),
+        }
+        self._entries.move_to_end(url)
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+
+class AssetFetcher:
+    """
+    Fetches the static assets referenced by a page the way a browser would, using at most
+    `max_connections` concurrent requests and a per-session AssetCache.
+    """
+
+    def __init__(self, session, max_connections, cache_size):
+        self._session = session
+        self._pool = Pool(max_connections)
+        self._cache = AssetCache(cache_size)
+
+    def fetch_page_assets(self, response):
+        template_key = get_template_key(response.url)
+        if template_key not in _template_assets:
+            _template_assets[template_key] = extract_assets(response.text)
+
+        urls = []
+        for reference in _template_assets[template_key]:
+            asset_url = urljoin(response.url, reference)
+            if asset_url not in urls:
+                urls.append(asset_url)
+        self._fetch_all(urls, referer=response.url)
+
+    def _fetch_all(self, urls, referer):
+        seen = set(urls)
+        while urls:
+            greenlets = [self._pool.spawn(self._fetch, url, referer) for url in urls if not self._cache.is_fresh(url)]
+            for greenlet in greenlets:
+                greenlet.join()
+
+            # Assets referenced from stylesheets (fonts, background images) are only requested once the stylesheet
+            # has loaded, and each asset is only visited once even if stylesheets reference each other
+            nested = []
+            for url in urls:
+                for asset_url in _stylesheet_assets.get(url, []):
+                    if asset_url not in seen:
+                        seen.add(asset_url)
+                        nested.append(asset_url)
+            urls = nested
+
+    def _fetch(self, url, referer):
+        headers = {'Referer': referer}
+        headers.update(self._cache.conditional_headers(url))
+
+        try:
+            response = self._session.get(url, headers=headers)
+        except Exception:
+            log.exception('Error fetching asset %s', url)
+            return
+
+        if response.status_code not in (200, 304):
+            log.warning('Got back a %d fetching asset %s', response.status_code, url)
+            return
+
+        self._cache.store(url, response)
+
+        if response.status_code == 200 and 'text/css' in response.headers.get('Content-Type', ''):
+            if url not in _stylesheet_assets:
+                _stylesheet_assets[url] = extract_stylesheet_assets(response.text, url)
@@ -0,0 +1,55 @@
+class Histogram:
+    """
+    Histogram of durations in seconds using the same exponential millisecond buckets as the stackdriver
+    page load time distribution.
+    """
+
+    def __init__(self, num_buckets=40, scale=1, growth_factor=1.4):
+        self._num_buckets = num_buckets
+        self._scale = scale
+        self._growth_factor = growth_factor
+        self.bucket_counts = [0] * num_buckets
+        self.count = 0
+        self.sum = 0.0
+
+    def get_bucket(self, value):
+        for i in range(self._num_buckets - 1):
+            if value * 1000 < self._scale * self._growth_factor ** i:
+                return i
+
+        return self._num_buckets - 1
+
+    def add(self, value):
+        self.bucket_counts[self.get_bucket(value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def extend(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        for i, bucket_count in enumerate(other.bucket_counts):
+            self.bucket_counts[i] += bucket_count
+        self.count += other.count
+        self.sum += other.sum
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound in seconds of the bucket containing the given percentile.
+        """
+        if not self.count:
+            return 0.0
+
+        threshold = self.count * percent / 100
+        seen = 0
+        for i, bucket_count in enumerate(self.bucket_counts):
+            seen += bucket_count
+            if seen >= threshold:
+                return self._scale * self._growth_factor ** i / 1000
+
+        return self._scale * self._growth_factor ** (self._num_buckets - 1) / 1000
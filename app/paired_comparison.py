@@ -0,0 +1,28 @@
+import math
+import statistics
+
+# Two-sided 95% critical values of Student's t distribution by degrees of freedom, above 30 the normal value is used
+_T_CRITICAL_95 = [
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+]
+_Z_CRITICAL_95 = 1.960
+
+
+def paired_difference(baseline, candidate):
+    """
+    Returns the mean of the paired differences `candidate - baseline` and the half width of its 95%
+    confidence interval, which is None when there are fewer than two pairs.
+    """
+    differences = [c - b for b, c in zip(baseline, candidate)]
+    if not differences:
+        return 0.0, None
+
+    mean = statistics.mean(differences)
+    if len(differences) < 2:
+        return mean, None
+
+    degrees_of_freedom = len(differences) - 1
+    critical = _T_CRITICAL_95[degrees_of_freedom - 1] if degrees_of_freedom <= len(_T_CRITICAL_95) else _Z_CRITICAL_95
+    return mean, critical * statistics.stdev(differences) / math.sqrt(len(differences))
@@ -0,0 +1,54 @@
+import re
+
+_TOKEN = r'[^\s,;="]+'
+_QUOTED_STRING = r'"(?:[^"\\]|\\.)*"'
+_SERVER_TIMING_PARAM_PATTERN = re.compile(r'\s*;\s*({token})\s*(?:=\s*({token}|{quoted}))?'.format(token=_TOKEN, quoted=_QUOTED_STRING))
+_SERVER_TIMING_ENTRY_PATTERN = re.compile(r'\s*({token})((?:\s*;\s*{token}\s*(?:=\s*(?:{token}|{quoted}))?)*)\s*(?:,|$)'.format(
+    token=_TOKEN, quoted=_QUOTED_STRING))
+# Used to skip a malformed entry up to the next comma that is not inside a quoted string
+_SERVER_TIMING_SKIP_PATTERN = re.compile(r'(?:[^,"]|{quoted}|")*,?'.format(quoted=_QUOTED_STRING))
+
+
+def parse_server_timing(header):
+    """
+    Parses a Server-Timing header such as `app;dur=47.2, db;desc="Database";dur=12` into a dict of
+    metric name to duration in milliseconds. Metrics without a duration and malformed entries are ignored.
+    """
+    metrics = {}
+    position = 0
+    while position < len(header):
+        entry = _SERVER_TIMING_ENTRY_PATTERN.match(header, position)
+        if not entry or entry.end() == position:
+            position = _SERVER_TIMING_SKIP_PATTERN.match(header, position).end() or len(header)
+            continue
+        position = entry.end()
+
+        for param in _SERVER_TIMING_PARAM_PATTERN.finditer(entry.group(2)):
+            if param.group(1).lower() == 'dur' and param.group(2):
+                try:
+                    duration = float(param.group(2).strip('"'))
+                except ValueError:
+                    break
+                metrics[entry.group(1)] = metrics.get(entry.group(1), 0.0) + duration
+                break
+
+    return metrics
+
+
+def get_server_timings(response, timing_headers=()):
+    """
+    Returns the durations in milliseconds reported by the server for a response, from its Server-Timing header
+    and from any of `timing_headers` which hold a single duration in milliseconds, named by the lower cased header.
+    """
+    metrics = parse_server_timing(response.headers.get('Server-Timing', ''))
+
+    for header in timing_headers:
+        value = response.headers.get(header)
+        if value is None:
+            continue
+        try:
+            metrics[header.lower()] = metrics.get(header.lower(), 0.0) + float(value)
+        except ValueError:
+            pass
+
+    return metrics
@@ -0,0 +1,178 @@
+import logging
+import random
+import re
+import time
+
+from gevent.event import Event
+from gevent.pool import Pool
+
+log = logging.getLogger(__name__)
+
+_HOUSEHOLD_FIELD_PATTERN = re.compile(r'^household-(\d+)-(.+)$')
+_DATE_FIELD_PATTERN = re.compile(r'^(.+)-(day|month|year)$')
+_REPEATING_ANSWER_PATTERN = re.compile(r'^(.+-answer)-(\d+)$')
+
+
+def _answer_key(group_instance, answer_instance, answer_id):
+    return '{}-{}-{}'.format(group_instance, answer_instance, answer_id)
+
+
+def _normalise_value(value):
+    if isinstance(value, list):
+        return ','.join(str(v) for v in value)
+    return str(value)
+
+
+def expected_answers(post_data, group_instance=0):
+    """
+    Converts the form data posted for a page into the answers survey runner should store for it,
+    keyed on group instance, answer instance and answer id.
+    """
+    answers = {}
+    dates = {}
+
+    for field, value in post_data.items():
+        if not value:
+            continue
+
+        date_match = _DATE_FIELD_PATTERN.match(field)
+        if date_match:
+            dates.setdefault(date_match.group(1), {})[date_match.group(2)] = int(value)
+            continue
+
+        answer_instance = 0
+        answer_id = field
+
+        household_match = _HOUSEHOLD_FIELD_PATTERN.match(field)
+        repeating_match = _REPEATING_ANSWER_PATTERN.match(field)
+        if household_match:
+            answer_instance, answer_id = int(household_match.group(1)), household_match.group(2)
+        elif repeating_match:
+            answer_id, answer_instance = repeating_match.group(1), int(repeating_match.group(2))
+
+        answers[_answer_key(group_instance, answer_instance, answer_id)] = _normalise_value(value)
+
+    for answer_id, parts in dates.items():
+        answers[_answer_key(group_instance, 0, answer_id)] = '{:04d}-{:02d}-{:02d}'.format(parts['year'], parts['month'], parts['day'])
+
+    return answers
+
+
+def diff_submission(expected, submission):
+    """
+    Compares the expected answers with the answers returned by /dump/submission and returns a list of
+    human readable differences.
+    """
+    actual = {
+        _answer_key(a['GroupInstance'], a['AnswerInstance'], a['AnswerId']): _normalise_value(a['Value'])
+        for a in submission
+    }
+
+    differences = []
+    for key, value in expected.items():
+        if key not in actual:
+            differences.append('missing value for {}'.format(key))
+        elif actual[key] != value:
+            differences.append('unexpected value for {}, expected {} actual {}'.format(key, value, actual[key]))
+
+    for key in actual.keys() - expected.keys():
+        if actual[key]:
+            differences.append('unexpected answer {} with value {}'.format(key, actual[key]))
+
+    return differences
+
+
+class PendingVerification:
+
+    def __init__(self, verifier):
+        self._verifier = verifier
+        self.fetched = Event()
+        self.cancelled = False
+
+    def wait_for_fetch(self, timeout):
+        """
+        Waits for the stored answers to be fetched. If they are not fetched in time the verification is cancelled,
+        as the dump may then be served after the submission has cleared the answers.
+        """
+        start_time = time.time()
+        if not self.fetched.wait(timeout):
+            self.cancelled = True
+        self._verifier.added_wait += time.time() - start_time
+
+
+class SubmissionVerifier:
+    """
+    Checks a sample of completed sessions against /dump/submission using a bounded pool of greenlets so that
+    fetching and diffing the stored answers happens outside of the timed page loads. Sessions that are sampled
+    while the pool is full are skipped rather than queued. The dump has to be fetched before the final submission,
+    so a sampled session can wait a short, bounded time past its think time for it, which is reported as `added_wait`.
+    """
+
+    def __init__(self, pool_size, sample_rate):
+        self._pool = Pool(pool_size)
+        self._sample_rate = sample_rate
+        self.sampled = 0
+        self.verified = 0
+        self.mismatched = 0
+        self.skipped = 0
+        self.errors = 0
+        self.added_wait = 0.0
+
+    def should_verify(self):
+        if random.random() < self._sample_rate:
+            self.sampled += 1
+            return True
+        return False
+
+    @property
+    def failed(self):
+        """
+        Whether the run should fail: a submission did not match, a submission could not be checked, or
+        submissions were sampled but none of them could be verified.
+        """
+        return bool(self.mismatched or self.errors or (self.sampled and not self.verified))
+
+    def verify(self, session, url, expected):
+        """
+        Starts verifying a submission and returns a PendingVerification which the session must wait on before
+        submitting, or None if the submission was skipped.
+        """
+        if self._pool.full():
+            self.skipped += 1
+            return None
+
+        verification = PendingVerification(self)
+        self._pool.spawn(self._verify, session, url, dict(expected), verification)
+        return verification
+
+    def _verify(self, session, url, expected, verification):
+        try:
+            response = session.get(url)
+        except Exception:
+            log.exception('Error fetching submission from %s', url)
+            self.errors += 1
+            return
+        finally:
+            verification.fetched.set()
+
+        if verification.cancelled:
+            log.warning('Submission from %s was fetched too late to verify', url)
+            self.skipped += 1
+            return
+
+        try:
+            if response.status_code != 200:
+                raise Exception('Got back a non-200 fetching submission: {}'.format(response.status_code))
+            differences = diff_submission(expected, response.json())
+        except Exception:
+            log.exception('Error verifying submission')
+            self.errors += 1
+            return
+
+        self.verified += 1
+        if differences:
+            self.mismatched += 1
+            log.warning('Submission did not match the answers given: %s', '; '.join(differences))
+
+    def join(self):
+        self._pool.join()
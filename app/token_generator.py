@@ -22,18 +22,29 @@ def get_file_contents(filename, trim=False):
     return data
 
 
-_key_store = KeyStore({
-    'keys': {
-        EQ_USER_AUTHENTICATION_RRM_PRIVATE_KEY_KID: {
-            'purpose': KEY_PURPOSE_AUTHENTICATION,
-            'type': 'private',
-            'value': get_file_contents('sdc-user-authentication-signing-rrm-private-key.pem')},
-        SR_USER_AUTHENTICATION_PUBLIC_KEY_KID: {
-            'purpose': KEY_PURPOSE_AUTHENTICATION,
-            'type': 'public',
-            'value': get_file_contents('sdc-user-authentication-encryption-sr-public-key.pem')},
-    }
-})
+_key_store = None
+
+
+def load_key_store():
+    """
+    Loads the signing and encryption keys on first use. Call this before minting tokens from several threads
+    so that the keys are only parsed once.
+    """
+    global _key_store
+    if _key_store is None:
+        _key_store = KeyStore({
+            'keys': {
+                EQ_USER_AUTHENTICATION_RRM_PRIVATE_KEY_KID: {
+                    'purpose': KEY_PURPOSE_AUTHENTICATION,
+                    'type': 'private',
+                    'value': get_file_contents('sdc-user-authentication-signing-rrm-private-key.pem')},
+                SR_USER_AUTHENTICATION_PUBLIC_KEY_KID: {
+                    'purpose': KEY_PURPOSE_AUTHENTICATION,
+                    'type': 'public',
+                    'value': get_file_contents('sdc-user-authentication-encryption-sr-public-key.pem')},
+            }
+        })
+    return _key_store
 
 
 def _get_payload_with_params(form_type_id, eq_id, survey_url=None, **extra_payload):
@@ -78,5 +89,14 @@ def create_token(form_type_id, eq_id, **extra_payload):
     return generate_token(payload_vars)
 
 
+def create_tokens(count, form_type_id, eq_id, **extra_payload):
+    """
+    Creates `count` tokens with the same metadata, e.g. to launch matched sessions against different survey
+    runners. Each token has its own collection exercise and case ids, so the sessions never share stored
+    questionnaire state even when the survey runners share a database.
+    """
+    return [generate_token(_get_payload_with_params(form_type_id, eq_id, None, **extra_payload)) for _ in range(count)]
+
+
 def generate_token(payload):
-    return encrypt(payload, _key_store, KEY_PURPOSE_AUTHENTICATION)
+    return encrypt(payload, load_key_store(), KEY_PURPOSE_AUTHENTICATION)
@@ -1,23 +1,49 @@
 import logging
+import os
 import re
 import time
+from collections import defaultdict, deque
 
 import requests
+from gevent.threadpool import ThreadPool
 
-from app.token_generator import create_token
+from app.assets import AssetFetcher, get_template_key
+from app.server_timing import get_server_timings
+from app.submission_verifier import expected_answers
+from app.token_generator import create_token, create_tokens, load_key_store
 
 log = logging.getLogger(__name__)
 
 
+LAUNCH_PAYLOAD = {'region_code': 'GB-ENG', 'variant_flags': {'sexual_identity': 'false'}, 'roles': ['dumper']}
+
+# Launch tokens expire an hour after they are minted, so pre-minted tokens are only used well within that
+LAUNCH_TOKEN_MAX_AGE = 45 * 60
+
+_launch_token_buffers = defaultdict(deque)
+
+
 class UserSession:
 
-    def __init__(self, host, wait_between_pages):
+    def __init__(self, host, wait_between_pages, fetch_assets=False, asset_connections=6, asset_cache_size=100,
+                 submission_verifier=None, timing_headers=(), server_processing_metrics=('app',),
+                 verification_fetch_grace=1):
         self._host = host
         self._wait_between_pages = wait_between_pages
         self._session = requests.session()
+        self._asset_fetcher = AssetFetcher(self._session, asset_connections, asset_cache_size) if fetch_assets else None
         self.page_load_times = []
-
-    def wait_and_submit_answer(self, post_data=None, url=None, action='save_continue', action_value=''):
+        self.page_complete_times = []
+        self._submission_verifier = submission_verifier
+        self._verification_fetch_grace = verification_fetch_grace
+        self.expected_answers = {}
+        self._timing_headers = timing_headers
+        self._server_processing_metrics = server_processing_metrics
+        self.page_timings = []
+
+    def wait_and_submit_answer(self, post_data=None, url=None, action='save_continue', action_value='', group_instance=0):
+        if post_data:
+            self.expected_answers.update(expected_answers(post_data, group_instance))
         time.sleep(self._wait_between_pages)
         self.submit_answer(post_data, url, action, action_value)
 
@@ -40,6 +66,7 @@ class UserSession:
         }
 
         response = self._session.post(url, data=_post_data, headers=headers, allow_redirects=False)
+        server_timings = [get_server_timings(response, self._timing_headers)]
 
         if response.status_code == 302:
             headers = {
@@ -48,12 +75,26 @@ class UserSession:
             }
 
             response = self._session.get(response.headers['location'], headers=headers, allow_redirects=False)
+            server_timings.append(get_server_timings(response, self._timing_headers))
 
         if response.status_code != 200:
             raise Exception('Got back a non-200: {}'.format(response.status_code))
 
         self._cache_response(response)
-        self.page_load_times.append(time.time() - start_time)
+        page_load_time = time.time() - start_time
+        self.page_load_times.append(page_load_time)
+        self._record_page_timing(response, page_load_time, server_timings)
+
+        if self._asset_fetcher:
+            self._asset_fetcher.fetch_page_assets(response)
+            self.page_complete_times.append(time.time() - start_time)
+
+    def _record_page_timing(self, response, page_load_time, server_timings, page=None):
+        server_processing_times = [
+            timings[metric] for timings in server_timings for metric in self._server_processing_metrics if metric in timings
+        ]
+        server_processing_time = sum(server_processing_times) / 1000 if server_processing_times else None
+        self.page_timings.append((page or get_template_key(response.url), page_load_time, server_processing_time))
 
     def _cache_response(self, response):
         self.last_csrf_token = self._extract_csrf_token(response.text)
@@ -73,21 +114,56 @@ class UserSession:
                 self.last_response.status_code
             ))
 
-    def launch_survey(self, form_type_id, eq_id, **payload_kwargs):
-        token = create_token(form_type_id=form_type_id, eq_id=eq_id, **payload_kwargs)
+    def launch_survey(self, form_type_id, eq_id, token=None, **payload_kwargs):
+        if token is None:
+            token = create_token(form_type_id=form_type_id, eq_id=eq_id, **payload_kwargs)
         url = '/session?token=' + token
+        start_time = time.time()
         response = self._session.get(self._host + url, allow_redirects=False)
+        server_timings = [get_server_timings(response, self._timing_headers)]
 
         if response.status_code != 302:
             raise Exception('Got a non-302 back when authenticating session: {}'.format(response.status_code))
 
         response = self._session.get(response.headers['location'])
+        server_timings.append(get_server_timings(response, self._timing_headers))
 
         self._cache_response(response)
+        self._record_page_timing(response, time.time() - start_time, server_timings, page='launch')
 
-    def start(self):
-        variant_flags = {'sexual_identity': 'false'}
-        self.launch_survey('household', 'census', region_code='GB-ENG', variant_flags=variant_flags, roles=['dumper'])
+        if self._asset_fetcher:
+            self._asset_fetcher.fetch_page_assets(response)
+
+    @staticmethod
+    def create_launch_tokens(count):
+        buffer = _launch_token_buffers[count]
+        while buffer:
+            minted_at, tokens = buffer.popleft()
+            if time.time() - minted_at < LAUNCH_TOKEN_MAX_AGE:
+                return tokens
+
+        return create_tokens(count, 'household', 'census', **LAUNCH_PAYLOAD)
+
+    @staticmethod
+    def prewarm_launch_tokens(number, count=1):
+        """
+        Mints `number` sets of `count` launch tokens on a pool of threads for later sessions to use, since
+        minting a token takes far longer than making a request.
+        """
+        load_key_store()
+        pool = ThreadPool(os.cpu_count() or 1)
+        results = [pool.spawn(create_tokens, count, 'household', 'census', **LAUNCH_PAYLOAD) for _ in range(number)]
+        for result in results:
+            _launch_token_buffers[count].append((time.time(), result.get()))
+        pool.kill()
+
+    def warm_up(self):
+        self._session.get(self._host + '/status')
+
+    def start(self, token=None):
+        if token is None:
+            token = self.create_launch_tokens(1)[0]
+        self.launch_survey('household', 'census', token=token)
 
         self.wait_and_submit_answer(action='start_questionnaire')
 
@@ -107,35 +183,17 @@ class UserSession:
 
     def complete_survey(self):
         self.assert_in_page('You’re ready to submit your 2017 Census Test')
-        #
-        # resp = self._session.get(self._host + '/dump/submission')
-        # eg = {'submission': {'case_id': 'a360486f-c5c9-4e73-9da4-66c5e6a742fd', 'collection': {'exercise_sid': 'f1291d42-1141-4833-aa9b-b6514d9b0210', 'instrument_id': 'household', 'period': '201604'}, 'data': [{'answer_id': 'address-line-1', 'answer_instance': 0, 'group_instance': 0, 'value': '44 hill side'}, {'answer_id': 'address-line-2', 'answer_instance': 0, 'group_instance': 0, 'value': 'cimla'}, {'answer_id': 'address-line-3', 'answer_instance': 0, 'group_instance': 0, 'value': ''}, {'answer_id': 'town-city', 'answer_instance': 0, 'group_instance': 0, 'value': 'neath'}, {'answer_id': 'county', 'answer_instance': 0, 'group_instance': 0, 'value': 'west glamorgan'}, {'answer_id': 'postcode', 'answer_instance': 0, 'group_instance': 0, 'value': 'cf336gn'}, {'answer_id': 'country', 'answer_instance': 0, 'group_instance': 0, 'value': 'wales'}, {'answer_id': 'permanent-or-family-home-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Yes'}, {'answer_id': 'first-name', 'answer_instance': 0, 'group_instance': 0, 'value': 'Danny'}, {'answer_id': 'first-name', 'answer_instance': 1, 'group_instance': 0, 'value': 'Anjali'}, {'answer_id': 'middle-names', 'answer_instance': 0, 'group_instance': 0, 'value': 'K'}, {'answer_id': 'middle-names', 'answer_instance': 1, 'group_instance': 0, 'value': 'K'}, {'answer_id': 'last-name', 'answer_instance': 0, 'group_instance': 0, 'value': 'Boje'}, {'answer_id': 'last-name', 'answer_instance': 1, 'group_instance': 0, 'value': 'Yo'}, {'answer_id': 'everyone-at-address-confirmation-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Yes'}, {'answer_id': 'overnight-visitors-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 2}, {'answer_id': 'household-relationships-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Husband or wife'}, {'answer_id': 'type-of-accommodation-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Whole house or bungalow'}, {'answer_id': 'type-of-house-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Detached'}, {'answer_id': 'self-contained-accommodation-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'No'}, {'answer_id': 'number-of-bedrooms-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 2}, {'answer_id': 'central-heating-answer', 'answer_instance': 0, 'group_instance': 0, 'value': ['Gas', 'Electric (include storage heaters)', 'Oil', 'Solid fuel (for example wood, coal)', 'Renewable (for example solar panels)', 'Other central heating', 'No central heating']}, {'answer_id': 'own-or-rent-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Owns outright'}, {'answer_id': 'number-of-vehicles-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 2}, {'answer_id': 'details-correct-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Yes, this is my full name'}, {'answer_id': 'over-16-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Yes'}, {'answer_id': 'private-response-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'No, I do not want to request a personal form'}, {'answer_id': 'sex-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Male'}, {'answer_id': 'date-of-birth-answer', 'answer_instance': 0, 'group_instance': 0, 'value': '1988-05-12'}, {'answer_id': 'marital-status-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'In a registered same-sex civil partnership'}, {'answer_id': 'another-address-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Yes, an address within the UK'}, {'answer_id': 'another-address-answer-other', 'answer_instance': 0, 'group_instance': 0, 'value': ''}, {'answer_id': 'other-address-answer-building', 'answer_instance': 0, 'group_instance': 0, 'value': '12'}, {'answer_id': 'other-address-answer-street', 'answer_instance': 0, 'group_instance': 0, 'value': ''}, {'answer_id': 'other-address-answer-city', 'answer_instance': 0, 'group_instance': 0, 'value': 'Newport'}, {'answer_id': 'other-address-answer-county', 'answer_instance': 0, 'group_instance': 0, 'value': ''}, {'answer_id': 'other-address-answer-postcode', 'answer_instance': 0, 'group_instance': 0, 'value': 'NP10 8XG'}, {'answer_id': 'address-type-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Other'}, {'answer_id': 'address-type-answer-other', 'answer_instance': 0, 'group_instance': 0, 'value': 'Friends Home'}, {'answer_id': 'in-education-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Yes'}, {'answer_id': 'term-time-location-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Yes'}, {'answer_id': 'country-of-birth-england-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'England'}, {'answer_id': 'country-of-birth-england-answer-other', 'answer_instance': 0, 'group_instance': 0, 'value': ''}, {'answer_id': 'country-of-birth-wales-answer-other', 'answer_instance': 0, 'group_instance': 0, 'value': ''}, {'answer_id': 'carer-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Yes, 1 -19 hours a week'}, {'answer_id': 'national-identity-england-answer', 'answer_instance': 0, 'group_instance': 0, 'value': ['English', 'Welsh', 'Scottish', 'Northern Irish', 'British', 'Other']}, {'answer_id': 'national-identity-england-answer-other', 'answer_instance': 0, 'group_instance': 0, 'value': 'Ind'}, {'answer_id': 'national-identity-wales-answer', 'answer_instance': 0, 'group_instance': 0, 'value': []}, {'answer_id': 'national-identity-wales-answer-other', 'answer_instance': 0, 'group_instance': 0, 'value': ''}, {'answer_id': 'ethnic-group-england-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Other ethnic group'}, {'answer_id': 'other-ethnic-group-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Other'}, {'answer_id': 'other-ethnic-group-answer-other', 'answer_instance': 0, 'group_instance': 0, 'value': 'Telugu'}, {'answer_id': 'language-england-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'English'}, {'answer_id': 'language-england-answer-other', 'answer_instance': 0, 'group_instance': 0, 'value': ''}, {'answer_id': 'language-welsh-answer-other', 'answer_instance': 0, 'group_instance': 0, 'value': ''}, {'answer_id': 'religion-answer', 'answer_instance': 0, 'group_instance': 0, 'value': ['No religion', 'Buddhism', 'Hinduism', 'Judaism', 'Islam', 'Sikhism', 'Other']}, {'answer_id': 'religion-answer-other', 'answer_instance': 0, 'group_instance': 0, 'value': 'Ind'}, {'answer_id': 'past-usual-address-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'This address'}, {'answer_id': 'past-usual-address-answer-other', 'answer_instance': 0, 'group_instance': 0, 'value': ''}, {'answer_id': 'passports-answer', 'answer_instance': 0, 'group_instance': 0, 'value': ['United Kingdom']}, {'answer_id': 'disability-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Yes, limited a lot'}, {'answer_id': 'qualifications-england-answer', 'answer_instance': 0, 'group_instance': 0, 'value': ['Masters Degree', 'Postgraduate Certificate / Diploma']}, {'answer_id': 'qualifications-welsh-answer', 'answer_instance': 0, 'group_instance': 0, 'value': []}, {'answer_id': 'employment-type-answer', 'answer_instance': 0, 'group_instance': 0, 'value': ['none of the above']}, {'answer_id': 'jobseeker-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Yes'}, {'answer_id': 'job-availability-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Yes'}, {'answer_id': 'job-pending-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Yes'}, {'answer_id': 'occupation-answer', 'answer_instance': 0, 'group_instance': 0, 'value': ['a student', 'long-term sick or disabled']}, {'answer_id': 'ever-worked-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Yes'}, {'answer_id': 'main-job-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'an employee'}, {'answer_id': 'hours-worked-answer', 'answer_instance': 0, 'group_instance': 0, 'value': '31 - 48'}, {'answer_id': 'work-travel-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Train'}, {'answer_id': 'job-title-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Software Engineer'}, {'answer_id': 'job-description-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Development'}, {'answer_id': 'main-job-type-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Employed by an organisation or business'}, {'answer_id': 'business-name-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'ONS'}, {'answer_id': 'employers-business-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Civil Servant'}, {'answer_id': 'details-correct-answer', 'answer_instance': 0, 'group_instance': 1, 'value': 'Yes, this is my full name'}, {'answer_id': 'over-16-answer', 'answer_instance': 0, 'group_instance': 1, 'value': 'Yes'}, {'answer_id': 'private-response-answer', 'answer_instance': 0, 'group_instance': 1, 'value': 'Yes, I want to request a personal form'}, {'answer_id': 'visitor-first-name', 'answer_instance': 0, 'group_instance': 0, 'value': 'Diya'}, {'answer_id': 'visitor-last-name', 'answer_instance': 0, 'group_instance': 0, 'value': 'K'}, {'answer_id': 'visitor-sex-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Female'}, {'answer_id': 'visitor-date-of-birth-answer', 'answer_instance': 0, 'group_instance': 0, 'value': '2016-11-04'}, {'answer_id': 'visitor-uk-resident-answer', 'answer_instance': 0, 'group_instance': 0, 'value': 'Yes, usually lives in the United Kingdom'}, {'answer_id': 'visitor-uk-resident-answer-other', 'answer_instance': 0, 'group_instance': 0, 'value': ''}, {'answer_id': 'visitor-address-answer-building', 'answer_instance': 0, 'group_instance': 0, 'value': '309'}, {'answer_id': 'visitor-address-answer-street', 'answer_instance': 0, 'group_instance': 0, 'value': ''}, {'answer_id': 'visitor-address-answer-city', 'answer_instance': 0, 'group_instance': 0, 'value': 'Vizag'}, {'answer_id': 'visitor-address-answer-county', 'answer_instance': 0, 'group_instance': 0, 'value': ''}, {'answer_id': 'visitor-address-answer-postcode', 'answer_instance': 0, 'group_instance': 0, 'value': '530003'}, {'answer_id': 'visitor-first-name', 'answer_instance': 0, 'group_instance': 1, 'value': 'Niki'}, {'answer_id': 'visitor-last-name', 'answer_instance': 0, 'group_instance': 1, 'value': 'K'}, {'answer_id': 'visitor-sex-answer', 'answer_instance': 0, 'group_instance': 1, 'value': 'Male'}, {'answer_id': 'visitor-date-of-birth-answer', 'answer_instance': 0, 'group_instance': 1, 'value': '1985-10-17'}, {'answer_id': 'visitor-uk-resident-answer', 'answer_instance': 0, 'group_instance': 1, 'value': 'Yes, usually lives in the United Kingdom'}, {'answer_id': 'visitor-uk-resident-answer-other', 'answer_instance': 0, 'group_instance': 1, 'value': ''}, {'answer_id': 'visitor-address-answer-building', 'answer_instance': 0, 'group_instance': 1, 'value': '1009'}, {'answer_id': 'visitor-address-answer-street', 'answer_instance': 0, 'group_instance': 1, 'value': ''}, {'answer_id': 'visitor-address-answer-city', 'answer_instance': 0, 'group_instance': 1, 'value': 'Detroit'}, {'answer_id': 'visitor-address-answer-county', 'answer_instance': 0, 'group_instance': 1, 'value': ''}, {'answer_id': 'visitor-address-answer-postcode', 'answer_instance': 0, 'group_instance': 1, 'value': '12345'}], 'flushed': False, 'metadata': {'ref_period_end_date': '2016-04-30', 'ref_period_start_date': '2016-04-01', 'ru_ref': '123456789012A', 'user_id': 'integration-test'}, 'origin': 'uk.gov.ons.edc.eq', 'started_at': '2018-10-31T11:44:13.151978+00:00', 'submitted_at': '2018-10-31T11:44:23.085403+00:00', 'survey_id': 'census', 'tx_id': '8330ac0c-ecbb-4f01-8877-b6eac5d0a412', 'type': 'uk.gov.ons.edc.eq:surveyresponse', 'version': '0.0.2'}}
-        #
-        # expected_flat = {str(a['group_instance']) + '-' + str(a['answer_instance']) + '-' + a['answer_id']: a['value'] for a in eg['submission']['data']}
-        # #actual_flat = {str(a['group_instance']) + '-' + str(a['answer_instance']) + '-' + a['answer_id']: a['value'] for a in resp.json()['submission']['data']}
-        # actual_flat = {str(a['GroupInstance']) + '-' + str(a['AnswerInstance']) + '-' + a['AnswerId']: a['Value'] for a in resp.json()}
-        #
-        # extra_keys = actual_flat.keys() - expected_flat.keys()
-        # if extra_keys:
-        #     raise Exception('Submission contained unexpected keys: {}'.format(extra_keys))
-        #
-        # for k, v in expected_flat.items():
-        #     if not v:
-        #         continue
-        #
-        #     if isinstance(v, int):
-        #         v = str(v)
-        #
-        #     if isinstance(v, list):
-        #         v = ','.join(v)
-        #
-        #     if k not in actual_flat:
-        #         raise Exception('Submission missing value for {}'.format(k))
-        #
-        #     if actual_flat[k] != v:
-        #         raise Exception('Submission contained unexpected value for {}, expected {} actual {}'.format(k, v, actual_flat[k]))
-
-        self.wait_and_submit_answer()
+
+        verification = None
+        if self._submission_verifier and self._submission_verifier.should_verify():
+            # The stored answers are cleared on submission, so they are fetched in the background while the
+            # session waits on the summary page and checked outside of the timed requests
+            verification = self._submission_verifier.verify(self._session, self._host + '/dump/submission', self.expected_answers)
+
+        time.sleep(self._wait_between_pages)
+        if verification:
+            verification.wait_for_fetch(self._verification_fetch_grace)
+        self.submit_answer(None, None, 'save_continue', '')
 
         self.assert_in_page('Submission successful')
 
@@ -193,7 +251,7 @@ class UserSession:
             },
         ]
         for post in post_data:
-            self.wait_and_submit_answer(post_data=post)
+            self.wait_and_submit_answer(post_data=post, group_instance=1)
 
         self.assert_in_page('You have completed all questions for Visitor 2')
         self.wait_and_submit_answer(action='save_continue')
@@ -353,7 +411,7 @@ class UserSession:
             }
         ]
         for post in post_data:
-            self.wait_and_submit_answer(post_data=post)
+            self.wait_and_submit_answer(post_data=post, group_instance=1)
 
         self.assert_in_page('Request for personal and confidential form')
         self.wait_and_submit_answer(action='save_continue')
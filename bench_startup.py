@@ -0,0 +1,97 @@
+"""
+Measures the cold start cost of the performance test pods: how long `import main` takes, how long it is from
+launching `python main.py` to survey runner receiving its first request of any kind (including pre-warming) and
+to it receiving the first survey launch, which starts the measured phase. A stub survey runner is started in
+process, e.g.
+
+    python bench_startup.py
+    BENCH_RUNS=10 PREWARM_TOKENS=20 PREWARM_CONNECTIONS=true python bench_startup.py
+
+Any other environment variables are passed through to main.py, so the effect of each mode and sink can be compared.
+"""
+import logging;logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from stub_server import StubHandler, create_server
+
+BENCH_RUNS = int(os.getenv('BENCH_RUNS', '5'))
+BENCH_PORT = int(os.getenv('BENCH_PORT', '5099'))
+BENCH_TIMEOUT = float(os.getenv('BENCH_TIMEOUT', '60'))
+
+IMPORT_TIME_SCRIPT = 'import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)'
+
+log = logging.getLogger(__name__)
+first_request = threading.Event()
+first_launch = threading.Event()
+
+
+class FirstRequestHandler(StubHandler):
+
+    def do_GET(self):
+        first_request.set()
+        if self.path.startswith('/session'):
+            first_launch.set()
+        super().do_GET()
+
+
+def bench_environment():
+    env = dict(os.environ)
+    env.setdefault('MODE', 'one_off')
+    env.setdefault('WAIT_BETWEEN_PAGES', '0')
+    env['SURVEY_RUNNER_URL'] = 'http://localhost:{}'.format(BENCH_PORT)
+    return env
+
+
+def measure_import_time():
+    output = subprocess.run([sys.executable, '-c', IMPORT_TIME_SCRIPT], env=bench_environment(), check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def measure_time_to_first_request():
+    """
+    Returns the time until the first request of any kind and the time until the first survey launch.
+    """
+    first_request.clear()
+    first_launch.clear()
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'main.py'], env=bench_environment(),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not first_request.wait(BENCH_TIMEOUT):
+            raise Exception('No request received within {} seconds'.format(BENCH_TIMEOUT))
+        request_time = time.perf_counter() - start
+        if not first_launch.wait(BENCH_TIMEOUT):
+            raise Exception('No survey launched within {} seconds'.format(BENCH_TIMEOUT))
+        return request_time, time.perf_counter() - start
+    finally:
+        process.kill()
+        process.wait()
+
+
+def summarise(name, times):
+    log.info('%s: median %.3f min %.3f max %.3f seconds over %d runs', name, statistics.median(times), min(times), max(times), len(times))
+
+
+if __name__ == '__main__':
+    server = create_server(BENCH_PORT)
+    server.RequestHandlerClass = FirstRequestHandler
+    # Killing main.py mid request is expected, so broken connections are not reported
+    server.handle_error = lambda request, client_address: None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    summarise('import main', [measure_import_time() for _ in range(BENCH_RUNS)])
+    request_times, launch_times = zip(*[measure_time_to_first_request() for _ in range(BENCH_RUNS)])
+    summarise('time to first request', request_times)
+    summarise('time to first survey launch', launch_times)
+
+    server.shutdown()
@@ -4,23 +4,16 @@ import logging;logging.basicConfig(
     level=logging.INFO,
     datefmt='%Y-%m-%d %H:%M:%S')
 
+import os
+import random
 import time
+from collections import OrderedDict
 
 import gevent
-from gevent import monkey; monkey.patch_all()
-
-import grpc.experimental.gevent as grpc_gevent; grpc_gevent.init_gevent()
-
-from google.cloud import monitoring_v3
-
-import os
-
-import requests
-
-from app.user_session import UserSession
 
 
 SURVEY_RUNNER_URL = os.getenv('SURVEY_RUNNER_URL', 'http://localhost:5000')
+SURVEY_RUNNER_URL_B = os.getenv('SURVEY_RUNNER_URL_B')
 SLACK_WEBHOOK = os.getenv('SLACK_WEBHOOK')
 SLACK_CHANNEL = os.getenv('SLACK_CHANNEL', '#catd')
 
@@ -35,6 +28,7 @@ NUM_WORKERS = int(os.getenv('NUM_WORKERS', '1'))
 MODE_CONTINUOUS = 'continuous'
 MODE_AFTER_DEPLOY = 'after_deploy'
 MODE_ONE_OFF = 'one_off'
+MODE_AB = 'ab'
 MODE = os.getenv('MODE', MODE_CONTINUOUS)
 
 SUBMISSIONS = int(os.getenv('SUBMISSIONS', '1'))
@@ -42,34 +36,126 @@ SUBMISSIONS = int(os.getenv('SUBMISSIONS', '1'))
 WAIT_BETWEEN_PAGES = int(os.getenv('WAIT_BETWEEN_PAGES', '5'))
 PAGE_LOAD_TIME_SUCCESS = float(os.getenv('PAGE_LOAD_TIME_SUCCESS', '1.2'))
 
+FETCH_ASSETS = os.getenv('FETCH_ASSETS', 'false').lower() == 'true'
+ASSET_CONNECTIONS = int(os.getenv('ASSET_CONNECTIONS', '6'))
+ASSET_CACHE_SIZE = int(os.getenv('ASSET_CACHE_SIZE', '100'))
+
+VERIFY_SUBMISSIONS = os.getenv('VERIFY_SUBMISSIONS', 'false').lower() == 'true'
+VERIFY_SAMPLE_RATE = float(os.getenv('VERIFY_SAMPLE_RATE', '1.0'))
+VERIFY_POOL_SIZE = int(os.getenv('VERIFY_POOL_SIZE', '4'))
+VERIFY_FETCH_GRACE = float(os.getenv('VERIFY_FETCH_GRACE', '1'))
+
+SERVER_TIMING_HEADERS = [h.strip() for h in os.getenv('SERVER_TIMING_HEADERS', '').split(',') if h.strip()]
+SERVER_PROCESSING_METRICS = [m.strip() for m in os.getenv('SERVER_PROCESSING_METRICS', 'app').split(',') if m.strip()]
+
+PREWARM_TOKENS = int(os.getenv('PREWARM_TOKENS', '0'))
+PREWARM_CONNECTIONS = os.getenv('PREWARM_CONNECTIONS', 'false').lower() == 'true'
+RAMP_UP_TIME = float(os.getenv('RAMP_UP_TIME', str(77 * WAIT_BETWEEN_PAGES)))
+
+# The stdlib only needs to be made cooperative when more than one greenlet makes requests at a time, so single
+# worker runs skip the cost of patching. This has to happen before requests is imported.
+if NUM_WORKERS > 1 or MODE == MODE_AB or FETCH_ASSETS or VERIFY_SUBMISSIONS or STACKDRIVER_ENABLED:
+    from gevent import monkey; monkey.patch_all()
+
+import requests
+
+from app.histogram import Histogram
+from app.paired_comparison import paired_difference
+from app.submission_verifier import SubmissionVerifier
+from app.user_session import UserSession
+
 log = logging.getLogger(__name__)
 stackdriver_page_load_times = []
 
 
-def worker(worker_id):
+def new_session(host, submission_verifier=None):
+    return UserSession(host, WAIT_BETWEEN_PAGES, FETCH_ASSETS, ASSET_CONNECTIONS, ASSET_CACHE_SIZE,
+                       submission_verifier, SERVER_TIMING_HEADERS, SERVER_PROCESSING_METRICS, VERIFY_FETCH_GRACE)
+
+
+def worker(worker_id, submission_verifier, warm_session=None):
     page_load_times = []
+    page_complete_times = []
+    page_timings = []
     num_submissions = SUBMISSIONS if MODE != MODE_CONTINUOUS else 1
     while num_submissions > 0:
         try:
             start_time = time.time()
             log.info('[%d] Starting survey', worker_id)
-            session = UserSession(SURVEY_RUNNER_URL, WAIT_BETWEEN_PAGES)
+            session = warm_session or new_session(SURVEY_RUNNER_URL, submission_verifier)
+            warm_session = None
             session.start()
             page_load_times += session.page_load_times
+            page_complete_times += session.page_complete_times
+            page_timings += session.page_timings
             if STACKDRIVER_ENABLED:
                 stackdriver_page_load_times.extend(session.page_load_times)
             average_page_load_time = sum(session.page_load_times) / len(session.page_load_times)
             log.info('[%d] Survey completed in %f seconds, average page load time was %.2f seconds', worker_id, time.time() - start_time, average_page_load_time)
+            if session.page_complete_times:
+                average_page_complete_time = sum(session.page_complete_times) / len(session.page_complete_times)
+                log.info('[%d] Average page complete time including assets was %.2f seconds', worker_id, average_page_complete_time)
             if MODE != MODE_CONTINUOUS:
                 num_submissions -= 1
         except Exception:
             log.exception('Error running session, will retry in 30 seconds')
             time.sleep(30)
 
-    return page_load_times
+    return page_load_times, page_complete_times, page_timings
+
+
+def run_session(session, token):
+    start_time = time.time()
+    session.start(token)
+    return time.time() - start_time
+
+
+def ab_worker(worker_id, targets, warm_sessions=None):
+    """
+    Runs pairs of sessions, one against each target, started together with tokens minted together from the
+    same metadata so that both targets see the same journeys at the same rate and under the same background load.
+    """
+    pairs = []
+    failures = [0] * len(targets)
+    pages_completed = [0] * len(targets)
+    start_time = time.time()
+    for _ in range(SUBMISSIONS):
+        log.info('[%d] Starting paired surveys', worker_id)
+        tokens = UserSession.create_launch_tokens(len(targets))
+        sessions = warm_sessions or [new_session(target) for target in targets]
+        warm_sessions = None
+
+        # Randomise which target is launched first so that neither consistently gets a head start
+        order = list(range(len(targets)))
+        random.shuffle(order)
+        greenlets = [None] * len(targets)
+        for i in order:
+            greenlets[i] = gevent.spawn(run_session, sessions[i], tokens[i])
+        gevent.joinall(greenlets)
+
+        # Throughput counts every page each target served, including those of failed or unmatched sessions
+        for i, session in enumerate(sessions):
+            pages_completed[i] += len(session.page_load_times)
+
+        if all(greenlet.successful() for greenlet in greenlets):
+            pairs.append([session.page_load_times for session in sessions])
+            log.info('[%d] Paired surveys completed in %s seconds', worker_id, ', '.join('{:.2f}'.format(g.value) for g in greenlets))
+            continue
+
+        for i, greenlet in enumerate(greenlets):
+            if not greenlet.successful():
+                failures[i] += 1
+                log.error('[%d] Error running session against %s: %r', worker_id, targets[i], greenlet.exception)
+        log.info('[%d] Discarding unmatched pair, will continue in 30 seconds', worker_id)
+        time.sleep(30)
+
+    return pairs, failures, pages_completed, time.time() - start_time
 
 
 def stackdriver_worker():
+    import grpc.experimental.gevent as grpc_gevent; grpc_gevent.init_gevent()
+    from google.cloud import monitoring_v3
+
     instance_id = requests.get("http://metadata.google.internal./computeMetadata/v1/instance/id", headers={'Metadata-Flavor': 'Google'}).text
     zone = requests.get("http://metadata.google.internal./computeMetadata/v1/instance/zone", headers={'Metadata-Flavor': 'Google'}).text
     zone = zone.split('/')[-1]
@@ -105,10 +191,9 @@ def stackdriver_worker():
             point.value.distribution_value.bucket_options.exponential_buckets.growth_factor = STACKDRIVER_GROWTH_FACTOR
             point.value.distribution_value.bucket_options.exponential_buckets.scale = STACKDRIVER_SCALE
 
-            counts = [0] * STACKDRIVER_BUCKETS
-            for p in stackdriver_page_load_times:
-                counts[get_stackdriver_bucket(p * 1000)] += 1
-            point.value.distribution_value.bucket_counts.extend(counts)
+            histogram = new_histogram()
+            histogram.extend(stackdriver_page_load_times)
+            point.value.distribution_value.bucket_counts.extend(histogram.bucket_counts)
 
             now = time.time()
             point.interval.end_time.seconds = int(now)
@@ -122,17 +207,71 @@ def stackdriver_worker():
             log.exception('Error sending metrics to stackdriver')
 
 
-def get_stackdriver_bucket(page_load_time):
-    for i in range(STACKDRIVER_BUCKETS - 1):
-        if page_load_time < STACKDRIVER_SCALE * STACKDRIVER_GROWTH_FACTOR ** i:
-            return i
-
-    return STACKDRIVER_BUCKETS - 1
-
-
-def get_version():
+def prewarm(targets=(SURVEY_RUNNER_URL,), submission_verifier=None):
+    """
+    Mints launch tokens and opens a connection to each target for each worker's first session in parallel before
+    the measured phase, so the first pages are not slowed down by key loading, DNS lookups and TLS handshakes.
+    Returns a list of sessions per worker, one for each target, or an empty list if connections are not pre-warmed.
+    """
+    token_minting = None
+    if PREWARM_TOKENS:
+        log.info('Pre-minting %d sets of %d launch tokens', PREWARM_TOKENS, len(targets))
+        token_minting = gevent.spawn(UserSession.prewarm_launch_tokens, PREWARM_TOKENS, len(targets))
+
+    worker_sessions = []
+    if PREWARM_CONNECTIONS:
+        log.info('Opening connections for %d sessions against each of %s', NUM_WORKERS, ', '.join(targets))
+        worker_sessions = [[new_session(target, submission_verifier) for target in targets] for _ in range(NUM_WORKERS)]
+        sessions = [session for sessions in worker_sessions for session in sessions]
+        for greenlet in gevent.joinall([gevent.spawn(session.warm_up) for session in sessions]):
+            if not greenlet.successful():
+                log.warning('Error opening connection: %r', greenlet.exception)
+
+    if token_minting:
+        token_minting.get()
+
+    return worker_sessions
+
+
+def new_histogram():
+    return Histogram(STACKDRIVER_BUCKETS, STACKDRIVER_SCALE, STACKDRIVER_GROWTH_FACTOR)
+
+
+def report_page_timings(page_timings):
+    """
+    Splits each page load time into the server processing time reported by the server and the remaining
+    network and queueing time, logs per page histograms of both and returns the overall histograms.
+    """
+    pages = OrderedDict()
+    for page, page_load_time, server_processing_time in page_timings:
+        if server_processing_time is None:
+            continue
+        network_histogram, server_histogram = pages.setdefault(page, (new_histogram(), new_histogram()))
+        network_histogram.add(max(page_load_time - server_processing_time, 0))
+        server_histogram.add(server_processing_time)
+
+    total_network_histogram, total_server_histogram = new_histogram(), new_histogram()
+    for page, (network_histogram, server_histogram) in pages.items():
+        log.info(
+            'Page %s: %d loads, network and queue time mean %.3f p50 %.3f p95 %.3f, server time mean %.3f p50 %.3f p95 %.3f',
+            page,
+            server_histogram.count,
+            network_histogram.mean,
+            network_histogram.percentile(50),
+            network_histogram.percentile(95),
+            server_histogram.mean,
+            server_histogram.percentile(50),
+            server_histogram.percentile(95)
+        )
+        total_network_histogram.merge(network_histogram)
+        total_server_histogram.merge(server_histogram)
+
+    return total_network_histogram, total_server_histogram
+
+
+def get_version(url=SURVEY_RUNNER_URL):
     try:
-        return requests.get(SURVEY_RUNNER_URL + '/status').json()['version']
+        return requests.get(url + '/status').json()['version']
     except Exception:
         log.exception('Error getting version')
         return None
@@ -171,26 +310,183 @@ def run_workers():
         WAIT_BETWEEN_PAGES
     )
 
+    submission_verifier = SubmissionVerifier(VERIFY_POOL_SIZE, VERIFY_SAMPLE_RATE) if VERIFY_SUBMISSIONS else None
+
+    warm_sessions = prewarm(submission_verifier=submission_verifier)
+
     workers = []
     if STACKDRIVER_ENABLED:
         workers.append(gevent.spawn(stackdriver_worker))
     for i in range(NUM_WORKERS):
-        workers.append(gevent.spawn(worker, i))
-        time.sleep(77 * WAIT_BETWEEN_PAGES / NUM_WORKERS)
-    page_load_times = [r.value for r in gevent.joinall(workers) if r.value]
-    page_load_times = [item for sublist in page_load_times for item in sublist]
+        workers.append(gevent.spawn(worker, i, submission_verifier, warm_sessions[i][0] if warm_sessions else None))
+        gevent.sleep(RAMP_UP_TIME / NUM_WORKERS)
+    results = [r.value for r in gevent.joinall(workers) if r.value]
+    page_load_times = [item for page_times, _, _ in results for item in page_times]
+    page_complete_times = [item for _, complete_times, _ in results for item in complete_times]
+    page_timings = [item for _, _, timings in results for item in timings]
 
     average_page_load_time = sum(page_load_times) / len(page_load_times)
     log.info('Average page load time was %.2f seconds', average_page_load_time)
 
+    message = 'The average page load time was *{:.2f}* seconds\n'.format(average_page_load_time)
+
+    if page_complete_times:
+        average_page_complete_time = sum(page_complete_times) / len(page_complete_times)
+        log.info('Average page complete time including assets was %.2f seconds', average_page_complete_time)
+        message += 'The average page complete time including assets was *{:.2f}* seconds\n'.format(average_page_complete_time)
+
+    network_histogram, server_histogram = report_page_timings(page_timings)
+    if server_histogram.count:
+        log.info(
+            'Average network and queue time was %.2f seconds, average server time was %.2f seconds',
+            network_histogram.mean,
+            server_histogram.mean
+        )
+        message += 'The average network and queue time was *{:.2f}* seconds, the average server time was *{:.2f}* seconds\n'.format(
+            network_histogram.mean,
+            server_histogram.mean
+        )
+
+    verification_failed = False
+    if submission_verifier:
+        submission_verifier.join()
+        verification_failed = submission_verifier.failed
+        log.info(
+            'Sampled %d submissions, verified %d, %d did not match, %d skipped, %d errors, sessions waited %.2f seconds for dumps',
+            submission_verifier.sampled,
+            submission_verifier.verified,
+            submission_verifier.mismatched,
+            submission_verifier.skipped,
+            submission_verifier.errors,
+            submission_verifier.added_wait
+        )
+        message += '*{}* of {} verified submissions did not match the answers given ({} sampled, {} skipped, {} errors, {:.2f} seconds waiting for dumps)\n'.format(
+            submission_verifier.mismatched,
+            submission_verifier.verified,
+            submission_verifier.sampled,
+            submission_verifier.skipped,
+            submission_verifier.errors,
+            submission_verifier.added_wait
+        )
+
+    announce_results(
+        message + '_{} workers each making {} submissions waiting {} seconds between pages_'.format(
+            NUM_WORKERS,
+            SUBMISSIONS,
+            WAIT_BETWEEN_PAGES
+        ),
+        "#D00000" if average_page_load_time > PAGE_LOAD_TIME_SUCCESS or verification_failed else "00D000"
+    )
+
+
+def format_difference(difference, half_width):
+    if half_width is None:
+        return '{:+.3f}'.format(difference)
+    return '{:+.3f} (95% CI {:+.3f} to {:+.3f})'.format(difference, difference - half_width, difference + half_width)
+
+
+def run_ab_workers():
+    if not SURVEY_RUNNER_URL_B:
+        raise Exception('SURVEY_RUNNER_URL_B must be set to run in {} mode'.format(MODE_AB))
+
+    targets = [SURVEY_RUNNER_URL, SURVEY_RUNNER_URL_B]
+    versions = [get_version(target) for target in targets]
+
+    log.info(
+        'Running %d workers each making %d paired submissions against %s (%s) and %s (%s) waiting %d seconds between pages',
+        NUM_WORKERS,
+        SUBMISSIONS,
+        targets[0],
+        versions[0],
+        targets[1],
+        versions[1],
+        WAIT_BETWEEN_PAGES
+    )
+
+    warm_sessions = prewarm(targets)
+
+    start_time = time.time()
+    workers = []
+    for i in range(NUM_WORKERS):
+        workers.append(gevent.spawn(ab_worker, i, targets, warm_sessions[i] if warm_sessions else None))
+        gevent.sleep(RAMP_UP_TIME / NUM_WORKERS)
+    results = [r.value for r in gevent.joinall(workers) if r.value]
+    elapsed = time.time() - start_time
+
+    pairs = [pair for worker_pairs, _, _, _ in results for pair in worker_pairs]
+    failures = [sum(worker_failures[i] for _, worker_failures, _, _ in results) for i in range(len(targets))]
+    pages_completed = [sum(worker_pages[i] for _, _, worker_pages, _ in results) for i in range(len(targets))]
+    throughputs = [pages / elapsed for pages in pages_completed]
+
+    # Each worker serves both targets over the same window, so its throughput against each target forms a pair
+    worker_throughputs = [[worker_pages[i] / worker_elapsed for _, _, worker_pages, worker_elapsed in results] for i in range(len(targets))]
+    throughput_difference, throughput_half_width = paired_difference(*worker_throughputs)
+
+    if not pairs:
+        log.error('No paired surveys completed')
+        announce_results('No paired surveys completed against {} and {}'.format(*targets), "#D00000")
+        return
+
+    message = ''
+    for i, target in enumerate(targets):
+        histogram = new_histogram()
+        for pair in pairs:
+            histogram.extend(pair[i])
+        log.info(
+            '%s (%s): %d surveys completed, %d failed, %.2f pages per second, page load time mean %.3f p50 %.3f p95 %.3f',
+            target,
+            versions[i],
+            len(pairs),
+            failures[i],
+            throughputs[i],
+            histogram.mean,
+            histogram.percentile(50),
+            histogram.percentile(95)
+        )
+        message += '{} ({}): average page load time *{:.2f}* seconds, p95 {:.2f} seconds, {:.2f} pages per second, {} failed surveys\n'.format(
+            target,
+            versions[i],
+            histogram.mean,
+            histogram.percentile(95),
+            throughputs[i],
+            failures[i]
+        )
+
+    page_load_times = [[sum(pair[i]) / len(pair[i]) for pair in pairs] for i in range(len(targets))]
+    page_load_difference, page_load_half_width = paired_difference(*page_load_times)
+
+    log.info('Paired page load time difference (B - A) was %s seconds', format_difference(page_load_difference, page_load_half_width))
+    log.info('Paired throughput difference (B - A) per worker was %s pages per second', format_difference(throughput_difference, throughput_half_width))
+
+    message += 'Paired page load time difference (B - A) was *{}* seconds\n'.format(format_difference(page_load_difference, page_load_half_width))
+    message += 'Paired throughput difference (B - A) per worker was *{}* pages per second\n'.format(format_difference(throughput_difference, throughput_half_width))
+
+    if page_load_half_width is None:
+        verdict = 'too few pairs to compare page load times'
+    elif page_load_difference - page_load_half_width > 0:
+        verdict = 'B is slower'
+    elif page_load_difference + page_load_half_width < 0:
+        verdict = 'B is faster'
+    else:
+        verdict = 'no significant difference in page load time'
+    slower = verdict == 'B is slower'
+
+    # Failed sessions are not part of the paired comparison, so any failure fails the run, whichever target it was against
+    if failures[1] > failures[0]:
+        verdict += ', B had {} more failed surveys than A'.format(failures[1] - failures[0])
+    elif any(failures):
+        verdict += ', {} failed surveys against A and {} against B'.format(*failures)
+
+    log.info('Verdict: %s', verdict)
+    message += 'Verdict: *{}*\n'.format(verdict)
+
     announce_results(
-        'The average page load time was *{:.2f}* seconds\n_{} workers each making {} submissions waiting {} seconds between pages_'.format(
-            average_page_load_time,
+        message + '_{} workers each making {} paired submissions waiting {} seconds between pages_'.format(
             NUM_WORKERS,
             SUBMISSIONS,
             WAIT_BETWEEN_PAGES
         ),
-        "#D00000" if average_page_load_time > PAGE_LOAD_TIME_SUCCESS else "00D000"
+        "#D00000" if slower or any(failures) else "00D000"
     )
 
 
@@ -211,4 +507,7 @@ if __name__ == '__main__':
 
             tested_version = current_version
 
-    run_workers()
+    if MODE == MODE_AB:
+        run_ab_workers()
+    else:
+        run_workers()
@@ -0,0 +1,135 @@
+"""
+Minimal stand-in for survey runner so the performance test can be run offline, e.g.
+
+    python stub_server.py &
+    MODE=one_off WAIT_BETWEEN_PAGES=0 SURVEY_RUNNER_URL=http://localhost:5000 python main.py
+
+Every questionnaire page contains the content the journey asserts on, posting a page redirects to the next
+block and every response carries a Server-Timing header with the simulated processing time and, when the
+request has an X-Request-Start header, the time it spent queued before being handled.
+"""
+import json
+import logging;logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from urllib.parse import urlparse
+
+STUB_PORT = int(os.getenv('STUB_PORT', '5000'))
+STUB_LATENCY = float(os.getenv('STUB_LATENCY', '0.05'))
+STUB_VERSION = os.getenv('STUB_VERSION', 'stub')
+
+QUESTIONNAIRE_PATH = '/questionnaire/census/household/'
+
+PAGE_CONTENT = [
+    'What is your address?',
+    'Who lives here?',
+    'You have successfully completed the ‘Who lives here?’ section',
+    'You have successfully completed the ‘Household and Accommodation’ section',
+    'Danny Boje',
+    'Anjali Yo',
+    'There are no more questions for Danny Boje',
+    'Request for personal and confidential form',
+    'There are no more questions for Anjali Yo',
+    'Name of visitor',
+    'You have completed all questions for Visitor 1',
+    'You have completed all questions for Visitor 2',
+    'You have successfully completed the ‘Visitors’ section',
+    'You’re ready to submit your 2017 Census Test',
+    'Submission successful',
+]
+
+PAGE_TEMPLATE = '''<html>
+<head><link rel="stylesheet" href="/s/main.css"><script src="/s/main.js"></script></head>
+<body>
+<form method="post">
+<input id="csrf_token" name="csrf_token" type="hidden" value="{csrf_token}">
+{content}
+<button>Save and continue</button>
+</form>
+</body>
+</html>'''
+
+STATIC_FILES = {
+    '/s/main.css': ('text/css', '@font-face { font-family: "OpenSans"; src: url(/s/font.woff2) }'),
+    '/s/main.js': ('application/javascript', ''),
+    '/s/font.woff2': ('font/woff2', ''),
+}
+
+log = logging.getLogger(__name__)
+_sessions = count()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+
+        if path == '/status':
+            self._respond(200, json.dumps({'version': STUB_VERSION}), 'application/json')
+        elif path == '/session':
+            self._redirect('block-0', {'Set-Cookie': 'session={}; Path=/'.format(next(_sessions))})
+        elif path.startswith(QUESTIONNAIRE_PATH):
+            self._respond(200, PAGE_TEMPLATE.format(
+                csrf_token='stub-token',
+                content='\n'.join('<p>{}</p>'.format(c) for c in PAGE_CONTENT)
+            ), 'text/html; charset=utf-8')
+        elif path in STATIC_FILES:
+            content_type, body = STATIC_FILES[path]
+            if self.headers.get('If-None-Match') == '"stub"':
+                self._respond(304, '', content_type, {'ETag': '"stub"'})
+            else:
+                self._respond(200, body, content_type, {'ETag': '"stub"', 'Cache-Control': 'max-age=60'})
+        else:
+            self._respond(404, 'Not found', 'text/plain')
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if not path.startswith(QUESTIONNAIRE_PATH):
+            self._respond(404, 'Not found', 'text/plain')
+            return
+
+        block = path.rsplit('/', 1)[-1]
+        self._redirect('block-{}'.format(int(block.split('-')[-1]) + 1))
+
+    def _redirect(self, block, headers=None):
+        location = 'http://{}{}{}'.format(self.headers['Host'], QUESTIONNAIRE_PATH, block)
+        self._respond(302, '', 'text/plain', dict(headers or {}, Location=location))
+
+    def _respond(self, status, body, content_type, headers=None):
+        received = time.time()
+        time.sleep(STUB_LATENCY)
+
+        server_timing = 'app;dur={:.1f}'.format((time.time() - received) * 1000)
+        if self.headers.get('X-Request-Start'):
+            queued = max(received * 1000 - int(self.headers['X-Request-Start']), 0)
+            server_timing += ', queue;dur={:.1f}'.format(queued)
+
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Server-Timing', server_timing)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def create_server(port=STUB_PORT):
+    return ThreadingHTTPServer(('', port), StubHandler)
+
+
+if __name__ == '__main__':
+    log.info('Stub survey runner listening on port %d', STUB_PORT)
+    create_server().serve_forever()